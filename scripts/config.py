@@ -42,6 +42,16 @@ TARGET_CRS = "EPSG:4326"  # Projection cible pour Leaflet
 SIMPLIFY_TOLERANCE = 0.00001  # Simplification géométrique (en degrés, ~1m)
 PRECISION = 6  # Précision décimale des coordonnées
 
+# === EXPORT LIGNE PAR LIGNE (RFC 8142) ===
+GEOJSON_SEQ = False  # Mettre True pour écrire les grosses couches en GeoJSONSeq (.geojsonl)
+GEOJSON_SEQ_THRESHOLD = 50000  # Nombre d'entités à partir duquel basculer en GeoJSONSeq
+
+# === CACHE GDAL ===
+GDAL_CACHEMAX_MB = 512  # Cache de blocs GDAL (Mo), garde les pages d'index GPKG entre les couches
+
+# === PARALLÉLISATION GÉOMÉTRIQUE ===
+PARALLEL_GEOMETRY_THRESHOLD = 50000  # Entités à partir desquelles le pipeline est découpé sur tous les cœurs
+
 # === PARAMÈTRES DE TRAITEMENT ===
 ATTRIBUTES_TO_KEEP = [
     # Liste des champs à conserver (laissez vide pour tout garder)
@@ -7,16 +7,23 @@ Script de traitement automatique des données SIG
 - Sauvegarde l'ancienne version avant écrasement
 """
 
+import atexit
+import os
+import queue
 import sys
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 from pathlib import Path
-import shutil
-import json
+
+import functools
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
-from shapely.geometry import mapping
+import pyproj
+import shapely
 
 # Import de la configuration
 from config import (
@@ -28,23 +35,41 @@ from config import (
     TARGET_CRS,
     SIMPLIFY_TOLERANCE,
     PRECISION,
-    ATTRIBUTES_TO_KEEP
+    ATTRIBUTES_TO_KEEP,
+    GEOJSON_SEQ,
+    GEOJSON_SEQ_THRESHOLD,
+    PARALLEL_GEOMETRY_THRESHOLD,
+    GDAL_CACHEMAX_MB
 )
 
+# Doit être posé avant la première lecture GDAL (hérité par les workers du pool)
+os.environ.setdefault('GDAL_CACHEMAX', str(GDAL_CACHEMAX_MB))
+
 
 # === CONFIGURATION DU LOGGING ===
 def setup_logging():
-    """Configure le système de logs"""
+    """
+    Configure le système de logs
+    Les écritures disque passent par un QueueListener en arrière-plan:
+    chaque logger.info du chemin chaud n'est qu'une mise en file d'attente
+    """
     log_file = LOG_DIR / f"process_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-    
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler(log_file, encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)
-        ]
-    )
+
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(log_file, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.handlers = [QueueHandler(log_queue)]
+
     return logging.getLogger(__name__)
 
 
@@ -61,29 +86,66 @@ def backup_existing_file(output_path):
     backup_name = f"{output_path.stem}_{timestamp}{output_path.suffix}"
     backup_path = BACKUP_DIR / backup_name
     
-    shutil.copy2(output_path, backup_path)
+    # Renommage atomique: aucune copie d'octets, le nouveau fichier est
+    # réécrit juste après par process_layer
+    os.replace(output_path, backup_path)
     logger.info(f"✅ Sauvegarde créée: {backup_path.name}")
     
     # Nettoyage: garde seulement les 3 dernières sauvegardes
-    backups = sorted(BACKUP_DIR.glob(f"{output_path.stem}_*{output_path.suffix}"))
+    # (os.scandir filtre sur les noms sans stat() par entrée, contrairement à glob)
+    prefix = f"{output_path.stem}_"
+    with os.scandir(BACKUP_DIR) as entries:
+        backups = sorted(
+            (entry for entry in entries
+             if entry.name.startswith(prefix) and entry.name.endswith(output_path.suffix)),
+            key=lambda entry: entry.name
+        )
     for old_backup in backups[:-3]:
-        old_backup.unlink()
+        os.unlink(old_backup.path)
         logger.info(f"🗑️  Ancienne sauvegarde supprimée: {old_backup.name}")
 
 
 # === FONCTION DE VALIDATION GÉOMÉTRIQUE ===
-def validate_and_fix_geometries(gdf):
+def validate_and_fix_geometries(geoms):
     """
-    Vérifie et corrige les géométries invalides
+    Vérifie et corrige les géométries invalides d'un tableau GEOS
     """
-    invalid_count = (~gdf.is_valid).sum()
-    
+    valid_mask = shapely.is_valid(geoms)
+    invalid_count = int((~valid_mask).sum())
+
     if invalid_count > 0:
         logger.warning(f"⚠️  {invalid_count} géométries invalides détectées")
-        gdf['geometry'] = gdf['geometry'].buffer(0)  # Fix classique
+        # make_valid uniquement sur les géométries cassées (buffer(0) reconstruisait
+        # toute la couche et écrase les anneaux auto-tangents)
+        geoms = geoms.copy()
+        geoms[~valid_mask] = shapely.make_valid(geoms[~valid_mask])
         logger.info(f"✅ Géométries corrigées")
-    
-    return gdf
+
+    return geoms
+
+
+# === FONCTION DE REPROJECTION ===
+@functools.lru_cache(maxsize=64)
+def _get_transformer(src_wkt):
+    """
+    Transformer pyproj mis en cache par CRS source
+    (la construction coûte ~100 ms et domine la reprojection des petites couches)
+    """
+    return pyproj.Transformer.from_crs(src_wkt, TARGET_CRS, always_xy=True)
+
+
+def reproject_geometries(geoms, src_crs):
+    """
+    Reprojette un tableau de géométries vers TARGET_CRS
+    avec le transformer en cache
+    """
+    transformer = _get_transformer(src_crs.to_wkt())
+
+    def _apply(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(geoms, _apply)
 
 
 # === FONCTION DE NETTOYAGE DES ATTRIBUTS ===
@@ -92,9 +154,10 @@ def clean_attributes(gdf):
     Nettoie et filtre les attributs
     """
     # Supprimer les colonnes qui ne servent à rien
-    columns_to_drop = [col for col in gdf.columns if col.startswith('__')]
-    if columns_to_drop:
-        gdf = gdf.drop(columns=columns_to_drop)
+    # (méthode chaîne vectorisée de l'Index, pas de boucle Python)
+    drop_mask = gdf.columns.str.startswith('__')
+    if drop_mask.any():
+        gdf = gdf.drop(columns=gdf.columns[drop_mask])
     
     # Filtrer selon ATTRIBUTES_TO_KEEP si défini
     if ATTRIBUTES_TO_KEEP:
@@ -102,60 +165,71 @@ def clean_attributes(gdf):
         gdf = gdf[cols_to_keep]
     
     # Convertir les dates en chaînes pour compatibilité JSON
-    for col in gdf.columns:
-        if pd.api.types.is_datetime64_any_dtype(gdf[col]):
+    # (cast vectorisé datetime64[D]→str, plus rapide que strftime par valeur;
+    # select_dtypes évite de re-scanner les colonnes non-datetime)
+    for col in gdf.select_dtypes(include=['datetime64[ns]', 'datetimetz']).columns:
+        if isinstance(gdf[col].dtype, pd.DatetimeTZDtype):
+            # Pas de cast direct possible pour les dates avec fuseau horaire
             gdf[col] = gdf[col].dt.strftime('%Y-%m-%d')
+        else:
+            # Les NaT deviendraient la chaîne 'NaT' après le cast, d'où le masque
+            gdf[col] = pd.Series(
+                gdf[col].values.astype('datetime64[D]').astype(str), index=gdf.index
+            ).where(gdf[col].notna(), None)
     
-    # Remplacer les valeurs NaN par None
-    gdf = gdf.where(pd.notnull(gdf), None)
-    
+    # Remplacer les valeurs NaN par None, uniquement sur les colonnes objet
+    # (les NaN numériques sont déjà sérialisés en null, et le masquage global
+    # allouait un DataFrame booléen complet + une copie en dtype objet)
+    obj_cols = gdf.columns[gdf.dtypes == object].difference(['geometry'])
+    for col in obj_cols:
+        gdf[col] = gdf[col].where(gdf[col].notna(), None)
+
     return gdf
 
 
+# === APPLICATION PAR MORCEAUX ===
+def apply_chunked(func, geoms):
+    """
+    Applique une ufunc shapely par morceaux sur tous les cœurs pour les
+    grosses couches (GEOS relâche le GIL, des threads suffisent)
+    """
+    n_chunks = os.cpu_count() or 1
+    if len(geoms) < PARALLEL_GEOMETRY_THRESHOLD or n_chunks == 1:
+        return func(geoms)
+
+    chunks = np.array_split(geoms, n_chunks)
+    with ThreadPoolExecutor(max_workers=n_chunks) as executor:
+        return np.concatenate(list(executor.map(func, chunks)))
+
+
 # === FONCTION DE COMPTAGE DES VERTICES ===
-def count_vertices(geom):
+def count_vertices(geoms):
     """
-    Compte le nombre de vertices d'une géométrie
-    Gère Polygon, MultiPolygon, LineString, MultiLineString
+    Compte le nombre total de vertices d'un tableau de géométries
+    (ufunc shapely 2.0, boucle en C sur le tableau GEOS)
     """
-    if geom is None:
-        return 0
-    
-    geom_type = geom.geom_type
-    
-    if geom_type == 'Polygon':
-        # Un seul polygone
-        return len(geom.exterior.coords)
-    
-    elif geom_type == 'MultiPolygon':
-        # Plusieurs polygones
-        return sum(len(poly.exterior.coords) for poly in geom.geoms)
-    
-    elif geom_type == 'LineString':
-        # Une ligne
-        return len(geom.coords)
-    
-    elif geom_type == 'MultiLineString':
-        # Plusieurs lignes
-        return sum(len(line.coords) for line in geom.geoms)
-    
-    elif geom_type == 'Point':
-        # Un point = 1 vertex
-        return 1
-    
-    elif geom_type == 'MultiPoint':
-        # Plusieurs points
-        return len(geom.geoms)
-    
-    else:
-        # Type inconnu
-        return 0
+    return int(shapely.get_num_coordinates(geoms).sum())
+
+
+# === FONCTION DE LECTURE ===
+def _read_layer(source_path):
+    """
+    Charge une couche source (pyogrio relâche le GIL pendant la lecture GDAL,
+    ce qui permet le préchargement sur un thread)
+    """
+    return gpd.read_file(
+        source_path,
+        engine='pyogrio',
+        use_arrow=True,
+        columns=ATTRIBUTES_TO_KEEP or None
+    )
 
 
 # === FONCTION PRINCIPALE DE TRAITEMENT ===
-def process_layer(layer_name, layer_config):
+def process_layer(layer_name, layer_config, gdf=None):
     """
     Traite une couche SIG complète
+    Accepte une GeoDataFrame déjà chargée (préchargement) via `gdf`
     """
     logger.info(f"\n{'='*60}")
     logger.info(f"🗺️  Traitement de la couche: {layer_name}")
@@ -177,70 +251,86 @@ def process_layer(layer_name, layer_config):
         
         # === 3. CHARGEMENT DES DONNÉES ===
         logger.info("📥 Chargement des données...")
-        gdf = gpd.read_file(source_path)
+        if gdf is None:
+            gdf = _read_layer(source_path)
         logger.info(f"✅ {len(gdf)} entités chargées")
         logger.info(f"📐 Projection source: {gdf.crs}")
         
-        # === 4. VALIDATION GÉOMÉTRIQUE ===
+        # === 4-6. PIPELINE GÉOMÉTRIQUE FUSIONNÉ ===
+        # Validation, reprojection, simplification et arrondi s'enchaînent
+        # en ufuncs shapely sur le même tableau GEOS, sans repasser par une
+        # GeoSeries intermédiaire à chaque étape
+        geoms = gdf.geometry.values
+
         logger.info("🔍 Validation des géométries...")
-        gdf = validate_and_fix_geometries(gdf)
-        
-        # === 5. REPROJECTION ===
+        geoms = validate_and_fix_geometries(geoms)
+
         if gdf.crs != TARGET_CRS:
             logger.info(f"🔄 Reprojection vers {TARGET_CRS}...")
-            gdf = gdf.to_crs(TARGET_CRS)
+            geoms = reproject_geometries(geoms, gdf.crs)
             logger.info("✅ Reprojection terminée")
-        
-        # === 6. SIMPLIFICATION GÉOMÉTRIQUE ===
+
         logger.info(f"✂️  Simplification (tolérance: {SIMPLIFY_TOLERANCE})...")
-        
-        # Compter avant simplification
-        original_vertices = gdf.geometry.apply(count_vertices).sum()
-        
-        # Simplification
-        gdf['geometry'] = gdf.geometry.simplify(SIMPLIFY_TOLERANCE, preserve_topology=True)
-        
-        # Compter après simplification
-        simplified_vertices = gdf.geometry.apply(count_vertices).sum()
-        
+
+        # Le comptage des vertices ne sert qu'au message de log: on s'épargne
+        # les deux passes sur les coordonnées si le niveau INFO est désactivé
+        count_for_log = logger.isEnabledFor(logging.INFO)
+        original_vertices = count_vertices(geoms) if count_for_log else 0
+
+        # Simplification (découpée sur tous les cœurs au-delà du seuil)
+        geoms = apply_chunked(
+            lambda g: shapely.simplify(g, SIMPLIFY_TOLERANCE, preserve_topology=True),
+            geoms
+        )
+
         # Calculer la réduction
-        if original_vertices > 0:
+        if count_for_log and original_vertices > 0:
+            simplified_vertices = count_vertices(geoms)
             reduction = 100 * (1 - simplified_vertices / original_vertices)
             logger.info(f"✅ Réduction de {reduction:.1f}% des vertices ({original_vertices} → {simplified_vertices})")
         else:
             logger.info(f"✅ Simplification terminée")
-        
+
+        # Arrondi des coordonnées au niveau GEOS (snap sur grille, en C)
+        geoms = apply_chunked(lambda g: shapely.set_precision(g, 10 ** -PRECISION), geoms)
+
+        # Réassemblage en une seule fois
+        gdf = gpd.GeoDataFrame(
+            gdf.drop(columns='geometry'), geometry=geoms, crs=TARGET_CRS
+        )
+
         # === 7. NETTOYAGE DES ATTRIBUTS ===
         logger.info("🧹 Nettoyage des attributs...")
         gdf = clean_attributes(gdf)
         logger.info(f"✅ {len(gdf.columns)-1} attributs conservés")
-        
+
         # === 8. EXPORT GEOJSON OPTIMISÉ ===
-        logger.info("💾 Export GeoJSON...")
+        # Au-delà du seuil, export en GeoJSONSeq (une entité par ligne,
+        # RFC 8142): lisible et post-traitable en flux, mémoire constante
+        if GEOJSON_SEQ and len(gdf) >= GEOJSON_SEQ_THRESHOLD:
+            driver = 'GeoJSONSeq'
+            output_path = output_path.with_suffix('.geojsonl')
+            backup_existing_file(output_path)  # le nom final diffère de celui déjà sauvegardé
+            layer_options = {'COORDINATE_PRECISION': PRECISION}
+            logger.info(f"💾 Export GeoJSONSeq ({len(gdf)} entités ≥ {GEOJSON_SEQ_THRESHOLD})...")
+        else:
+            driver = 'GeoJSON'
+            layer_options = {'COORDINATE_PRECISION': PRECISION, 'WRITE_BBOX': 'NO'}
+            logger.info("💾 Export GeoJSON...")
+
+        # Écriture vers un fichier temporaire puis renommage atomique:
+        # les lecteurs ne voient jamais de fichier tronqué
+        tmp_path = output_path.with_name(output_path.name + '.tmp')
         gdf.to_file(
-            output_path,
-            driver='GeoJSON',
-            encoding='utf-8'
+            tmp_path,
+            driver=driver,
+            engine='pyogrio',
+            encoding='utf-8',
+            layer_options=layer_options
         )
-        
-        # === 9. OPTIMISATION FINALE (réduction précision) ===
-        with open(output_path, 'r', encoding='utf-8') as f:
-            geojson_data = json.load(f)
-        
-        # Arrondir les coordonnées pour réduire la taille
-        def round_coords(coords):
-            if isinstance(coords[0], list):
-                return [round_coords(c) for c in coords]
-            return [round(c, PRECISION) for c in coords]
-        
-        for feature in geojson_data['features']:
-            geom = feature['geometry']
-            geom['coordinates'] = round_coords(geom['coordinates'])
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            json.dump(geojson_data, f, ensure_ascii=False, separators=(',', ':'))
-        
-        # === 10. STATISTIQUES FINALES ===
+        os.replace(tmp_path, output_path)
+
+        # === 9. STATISTIQUES FINALES ===
         file_size = output_path.stat().st_size / 1024  # en Ko
         logger.info(f"✅ Export terminé: {output_path.name}")
         logger.info(f"📊 Taille finale: {file_size:.2f} Ko")
@@ -253,6 +343,19 @@ def process_layer(layer_name, layer_config):
         return False
 
 
+# === EXÉCUTION DANS LE POOL DE PROCESSUS ===
+def _init_worker():
+    """Initialise le logging dans chaque processus du pool"""
+    global logger
+    logger = setup_logging()
+
+
+def _run_layer(item):
+    """Déroule un élément de LAYERS_CONFIG vers process_layer (picklable pour le pool)"""
+    layer_name, layer_config = item
+    return process_layer(layer_name, layer_config)
+
+
 # === FONCTION PRINCIPALE ===
 def main():
     """
@@ -266,13 +369,35 @@ def main():
     logger.info("="*80)
     logger.info(f"📅 Date: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
-    success_count = 0
     total_count = len(LAYERS_CONFIG)
-    
-    # Traiter chaque couche
-    for layer_name, layer_config in LAYERS_CONFIG.items():
-        if process_layer(layer_name, layer_config):
-            success_count += 1
+
+    # Traiter les couches en parallèle: sources et sorties indépendantes,
+    # les lectures GDAL et la simplification se recouvrent entre processus
+    max_workers = min(total_count, os.cpu_count() or 1)
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+            results = list(executor.map(_run_layer, LAYERS_CONFIG.items()))
+        success_count = sum(results)
+    else:
+        # Séquentiel: la lecture de la couche suivante démarre sur un thread
+        # pendant les phases CPU de la couche courante (le GIL est relâché
+        # pendant la lecture GDAL)
+        success_count = 0
+        items = list(LAYERS_CONFIG.items())
+        with ThreadPoolExecutor(max_workers=1) as reader:
+            next_read = None
+            for i, (layer_name, layer_config) in enumerate(items):
+                try:
+                    gdf = next_read.result() if next_read is not None else None
+                except Exception:
+                    gdf = None  # process_layer relira et journalisera l'erreur
+                next_read = None
+                if i + 1 < len(items):
+                    next_path = RAW_DATA_DIR / items[i + 1][1]['source_file']
+                    if next_path.exists():
+                        next_read = reader.submit(_read_layer, next_path)
+                if process_layer(layer_name, layer_config, gdf=gdf):
+                    success_count += 1
     
     # === RAPPORT FINAL ===
     logger.info("\n" + "="*80)